@@ -133,11 +133,12 @@ class SimVP(EncoderDecoder):
 
         z = embed.view(B, T, C_, H_, W_)
         hid = self.hid(z)
-        hid = hid.reshape(B*T, C_, H_, W_)
 
-        Y = self.dec(hid, skip)
-        Y = Y.reshape(B, T, C, H, W)
-        Y = Y[:, 0, :, :, :]
-        Y = torch.squeeze(Y, dim = 1)
-        
+        # The decoder works on each frame independently and only the first
+        # frame is kept, so decode that frame alone instead of all B*T
+        hid = hid[:, 0, :, :, :]
+        skip = skip.view(B, T, *skip.shape[1:])[:, 0, :, :, :]
+
+        Y = self.dec(hid, skip)  # (B, C, H, W)
+
         return self.softmax(Y)
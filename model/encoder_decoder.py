@@ -16,6 +16,7 @@ from torch.nn import functional as F
 from torch.optim import lr_scheduler
 import torch.optim as optim
 import pytorch_lightning as pl
+from pytorch_lightning.trainer.states import TrainerFn
 
 
 class EncoderDecoder(pl.LightningModule):
@@ -54,6 +55,9 @@ class EncoderDecoder(pl.LightningModule):
         self.crop_encoding = crop_encoding
         self.run_path = Path(run_path)
 
+        # Optional augmentation applied to whole training batches on the GPU
+        self.gpu_transform = None
+
         # self.save_hyperparameters()
 
     def forward(self):
@@ -67,8 +71,31 @@ class EncoderDecoder(pl.LightningModule):
         }
         return [optimizer], [step_lr_scheduler]
 
+    def optimizer_zero_grad(self, epoch, batch_idx, optimizer, optimizer_idx=0):
+        # Free the gradients instead of filling them with zeros
+        optimizer.zero_grad(set_to_none=True)
+
+
+    def reset_losses(self):
+        '''
+        Clears the recorded losses, e.g. those left by batch size tuning trials.
+        '''
+        self.epoch_train_losses = []
+        self.epoch_valid_losses = []
+        self.avg_train_losses = []
+        self.avg_val_losses = []
+
+    def on_train_epoch_start(self):
+        # Reshuffle the distributed sampler of the datamodule (if any)
+        datamodule = getattr(self.trainer, 'datamodule', None)
+        sampler = getattr(datamodule, 'train_sampler', None)
+        if sampler is not None:
+            sampler.set_epoch(self.current_epoch)
 
     def training_step(self, batch, batch_idx):
+        if self.gpu_transform is not None:
+            batch = self.gpu_transform(batch)
+
         inputs = batch['medians']  # (B, T, C, H, W)
         label = batch['labels']  # (B, H, W)
         label = label.to(torch.long)
@@ -220,13 +247,16 @@ class EncoderDecoder(pl.LightningModule):
     def training_epoch_end(self, outputs):
         # Calculate average loss over an epoch
         train_loss = np.nanmean(self.epoch_train_losses)
-        self.avg_train_losses.append(train_loss)
 
-        with open(self.run_path / "avg_train_losses.txt", 'a') as f:
-            f.write(f'{self.current_epoch}: {train_loss}\n')
+        # Trials of the batch size finder must not be recorded
+        if self.trainer.state.fn != TrainerFn.TUNING:
+            self.avg_train_losses.append(train_loss)
 
-        with open(self.run_path / 'lrs.txt', 'a') as f:
-            f.write(f'{self.current_epoch}: {self.learning_rate}\n')
+            with open(self.run_path / "avg_train_losses.txt", 'a') as f:
+                f.write(f'{self.current_epoch}: {train_loss}\n')
+
+            with open(self.run_path / 'lrs.txt', 'a') as f:
+                f.write(f'{self.current_epoch}: {self.learning_rate}\n')
 
         self.log('train_loss', train_loss, prog_bar=True)
 
@@ -237,10 +267,12 @@ class EncoderDecoder(pl.LightningModule):
     def validation_epoch_end(self, outputs):
         # Calculate average loss over an epoch
         valid_loss = np.nanmean(self.epoch_valid_losses)
-        self.avg_val_losses.append(valid_loss)
 
-        with open(self.run_path / "avg_val_losses.txt", 'a') as f:
-            f.write(f'{self.current_epoch}: {valid_loss}\n')
+        if self.trainer.state.fn != TrainerFn.TUNING:
+            self.avg_val_losses.append(valid_loss)
+
+            with open(self.run_path / "avg_val_losses.txt", 'a') as f:
+                f.write(f'{self.current_epoch}: {valid_loss}\n')
 
         self.log('val_loss', valid_loss, prog_bar=True)
 
@@ -340,21 +340,18 @@ class TemporallySharedBlock(nn.Module):
         else:
             b, t, c, h, w = input.shape
 
-            if self.pad_value is not None:
-                dummy = torch.zeros(input.shape, device=input.device).float()
-                self.out_shape = self.forward(dummy.view(b * t, c, h, w)).shape
-
             out = input.view(b * t, c, h, w)
             if self.pad_value is not None:
                 pad_mask = (out == self.pad_value).all(dim=-1).all(dim=-1).all(dim=-1)
                 if pad_mask.any():
-                    temp = (
-                        torch.ones(
-                            self.out_shape, device=input.device, requires_grad=False
-                        )
-                        * self.pad_value
+                    # Only run the block on the non-padded frames, the output
+                    # shape is taken from that result instead of a dummy pass
+                    valid = self.forward(out[~pad_mask])
+                    self.out_shape = (b * t, *valid.shape[1:])
+                    temp = torch.full(
+                        self.out_shape, self.pad_value, dtype=valid.dtype, device=input.device
                     )
-                    temp[~pad_mask] = self.forward(out[~pad_mask])
+                    temp[~pad_mask] = valid
                     out = temp
                 else:
                     out = self.forward(out)
@@ -2,10 +2,13 @@
 This script runs a baseline model on the given data in train
 and/or in test mode, and exports the results.
 
-In order to be used as model inputs, the training data are further split into
-sequences using a rolling window of a fixed size.
+The model inputs are the monthly medians from start_month up to end_month,
+randomly cropped to 64x64 sub-patches for training and validation.
 '''
 import argparse
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
 
@@ -19,17 +22,70 @@ from model.SimVP import SimVP
 import pytorch_lightning as pl
 from pytorch_lightning import loggers as pl_loggers
 from pytorch_lightning.callbacks import EarlyStopping, ModelCheckpoint, LearningRateMonitor
-from pytorch_lightning.plugins import DDPPlugin
+from pytorch_lightning.plugins import TorchCheckpointIO
+from pytorch_lightning.strategies import DDPStrategy
+from pytorch_lightning.tuner.tuning import Tuner
+from pytorch_lightning.utilities.apply_func import apply_to_collection
 import torch
+import torch.multiprocessing as mp
 
 from utils.PAD_datamodule import PADDataModule
+from utils.modules import BatchRandomFlip
 from utils.tools import font_colors
-from utils.settings.config import RANDOM_SEED, CROP_ENCODING, LINEAR_ENCODER, CLASS_WEIGHTS, BANDS
+from utils.settings.config import RANDOM_SEED, CROP_ENCODING, CROP_ENCODING_LINEAR, LINEAR_ENCODER, CLASS_WEIGHTS, BANDS
 
 # Set seed for everything
 pl.seed_everything(RANDOM_SEED)
 
 
+class ThreadedCheckpointIO(TorchCheckpointIO):
+    '''
+    Writes checkpoints on a background thread so that training continues
+    while they are saved. The tensors are copied to CPU memory before the save
+    is queued, so later optimizer steps cannot change what is written.
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = []
+
+    def save_checkpoint(self, checkpoint, path, storage_options=None):
+        # Raise errors of finished saves now instead of at the end of training
+        done = [future for future in self._pending if future.done()]
+        self._pending = [future for future in self._pending if not future.done()]
+        for future in done:
+            future.result()
+
+        cpu_checkpoint = apply_to_collection(checkpoint, torch.Tensor,
+                                             lambda t: t.detach().to('cpu', copy=True))
+        # apply_to_collection rebuilds the state_dict and drops its version info
+        metadata = getattr(checkpoint.get('state_dict'), '_metadata', None)
+        if metadata is not None:
+            cpu_checkpoint['state_dict']._metadata = metadata
+
+        self._pending.append(
+            self._executor.submit(super().save_checkpoint, cpu_checkpoint, path, storage_options)
+        )
+
+    def wait(self):
+        # Re-raises any error that happened while saving
+        pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
+
+    def load_checkpoint(self, *args, **kwargs):
+        self.wait()
+        return super().load_checkpoint(*args, **kwargs)
+
+    def remove_checkpoint(self, path):
+        self.wait()
+        super().remove_checkpoint(path)
+
+    def teardown(self):
+        self.wait()
+
+
 def resume_or_start(results_path, resume, train, num_epochs, load_checkpoint):
     '''
     Checks whether training must resume or start from scratch and returns
@@ -65,11 +121,11 @@ def resume_or_start(results_path, resume, train, num_epochs, load_checkpoint):
         resume_from_checkpoint = load_checkpoint
     elif resume == 'last':
         # Use last run's latest checkpoint to resume training
-        run_paths = sorted(results_path.glob('run_*'))
-        run_path = run_paths[-1]
+        # Run names are timestamps, so the last run is the largest name
+        run_path = max(results_path.glob('run_*'), key=lambda p: p.name)
 
         epoch_ckpt = {int(x.stem.split('=')[-1]): x for x in (run_path / 'checkpoints').glob('*')}
-        init_epoch = sorted(epoch_ckpt.keys())[-1]
+        init_epoch = max(epoch_ckpt)
         ckpt_path = epoch_ckpt[init_epoch]
 
         init_epoch = int(init_epoch)
@@ -94,6 +150,38 @@ def resume_or_start(results_path, resume, train, num_epochs, load_checkpoint):
     return run_path, resume_from_checkpoint, max_epoch, init_epoch
 
 
+def resolve_precision(precision, num_gpus):
+    '''
+    Maps the --precision argument to a value understood by pl.Trainer.
+    'auto' picks bf16 mixed precision when the GPU supports it, fp16 mixed
+    precision on older GPUs and full precision when running on CPU.
+    '''
+    if precision == 'auto':
+        if num_gpus == 0 or not torch.cuda.is_available():
+            return 32
+        return 'bf16' if torch.cuda.is_bf16_supported() else 16
+
+    if precision == 'bf16':
+        return precision
+
+    return int(precision)
+
+
+def create_strategy(num_gpus, find_unused_parameters=False):
+    '''
+    Returns the DDP strategy to use for multi-GPU runs, or None for a single
+    device. The graph is assumed static, so that DDP can precompute its
+    gradient buckets once. Models with branches that leave some parameters
+    unused in a step must be run with find_unused_parameters=True.
+    '''
+    if num_gpus <= 1:
+        return None
+
+    return DDPStrategy(static_graph=True,
+                       find_unused_parameters=find_unused_parameters,
+                       gradient_as_bucket_view=True)
+
+
 def create_model_log_path(log_path, prefix, model):
     '''
     Creates the path to contain results for the given model.
@@ -105,6 +193,12 @@ def create_model_log_path(log_path, prefix, model):
 
 
 def main():
+    # Use TF32 Tensor Cores for the fp32 matmuls/convs left by mixed precision,
+    # and let cuDNN autotune its conv algorithms for the fixed input size
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cudnn.benchmark = True
+
     # Parse user arguments
     parser = argparse.ArgumentParser()
 
@@ -125,6 +219,9 @@ def main():
     parser.add_argument('--weighted_loss', action='store_true', default=False, required=False,
                             help='Use a weighted loss function with precalculated weights per class. Default False.')
 
+    parser.add_argument('--gpu_flips', action='store_true', default=False, required=False,
+                            help='Augment training batches with random flips applied on the GPU. Default False')
+
     parser.add_argument('--binary_labels', action='store_true', default=False, required=False,
                              help='Map categories to 0 background, 1 parcel. Default False')
     parser.add_argument('--root_dir', type=str, default='dataset',
@@ -138,6 +235,9 @@ def main():
                              help='Number of epochs. Default 10')
     parser.add_argument('--batch_size', type=int, default=4, required=False,
                              help='The batch size. Default 4')
+    parser.add_argument('--auto_batch_size', action='store_true', default=False, required=False,
+                             help='Find the largest batch size that fits in memory, starting from --batch_size, '
+                                  'and scale the learning rate linearly. Single GPU only. Default False')
     parser.add_argument('--lr', type=float, default=1e-1, required=False,
                              help='Starting learning rate. Default 1e-1')
 
@@ -150,12 +250,33 @@ def main():
     parser.add_argument('--start_month', type=int, default=4, choices=range(1, 12))
     parser.add_argument('--end_month', type=int, default=10, choices=range(1, 14))
 
+    parser.add_argument('--precision', type=str, default='auto', choices=['auto', 'bf16', '16', '32'],
+                             help='Training precision. "auto" uses bf16 mixed precision if supported, '
+                                  'else 16-bit mixed precision. Default "auto"')
+
+    parser.add_argument('--no_channels_last', dest='channels_last', action='store_false',
+                             help='Keep the conv weights of unet/utae/simvp in NCHW instead of channels_last.')
+    parser.add_argument('--compile', action='store_true', default=False, required=False,
+                             help='Compile the model forward pass with torch.compile (PyTorch >= 2.0). Default False')
+
     parser.add_argument('--num_workers', type=int, default=6, required=False,
                              help='Number of workers to work on dataloader. Default 6')
+    parser.add_argument('--no_persistent_workers', dest='persistent_workers', action='store_false',
+                             help='Re-spawn dataloader workers every epoch instead of keeping them alive.')
+    parser.add_argument('--prefetch_factor', type=int, default=4, required=False,
+                             help='Number of batches prefetched by each dataloader worker. Default 4')
+    parser.add_argument('--no_cuda_prefetch', dest='cuda_prefetch', action='store_false',
+                             help='Do not copy the next batch to the GPU on a side CUDA stream.')
+    parser.add_argument('--gpu_normalize', action='store_true', default=False, required=False,
+                             help='Load raw uint16 medians and normalize them on the GPU instead of '
+                                  'the per-sample min-max normalization. Default False')
     parser.add_argument('--num_gpus', type=int, default=1, required=False,
                              help='Number of gpus to use (per node). Default 1')
     parser.add_argument('--num_nodes', type=int, default=1, required=False,
                              help='Number of nodes to use. Default 1')
+    parser.add_argument('--find_unused_parameters', action='store_true', default=False, required=False,
+                             help='Let DDP search for parameters unused in the forward pass. Only needed '
+                                  'for models with conditional branches. Default False')
 
     args = parser.parse_args()
 
@@ -201,11 +322,14 @@ def main():
     else:
         class_weights = None
 
-    # define crop_encoding
-    crop_encoding_rev = {v: k for k, v in CROP_ENCODING.items()}
-    crop_encoding = {k: crop_encoding_rev[k] for k in LINEAR_ENCODER.keys() if k != 0}
-    crop_encoding[0] = 'Background/Other'
     timestep = int(args.end_month - args.start_month)
+    precision = resolve_precision(args.precision, args.num_gpus)
+
+    # Load checkpoints straight to this process' GPU instead of staging on CPU
+    if torch.cuda.is_available() and args.num_gpus > 0:
+        map_location = torch.device('cuda', int(os.environ.get('LOCAL_RANK', 0)))
+    else:
+        map_location = torch.device('cpu')
         
     if args.model == 'convlstm':
         args.img_size = [int(dim) for dim in args.img_size]
@@ -237,10 +361,10 @@ def main():
         if not args.train:
             # Load the model for testing
             model = ConvLSTM.load_from_checkpoint(resume_from_checkpoint,
-                                                  map_location=torch.device('cpu'),
+                                                  map_location=map_location,
                                                   run_path=run_path,
                                                   linear_encoder=LINEAR_ENCODER,
-                                                  crop_encoding=crop_encoding,
+                                                  crop_encoding=CROP_ENCODING_LINEAR,
                                                   checkpoint_epoch=init_epoch)
     elif args.model == 'convstar':
         args.img_size = [int(dim) for dim in args.img_size]
@@ -271,10 +395,10 @@ def main():
 
         if not args.train:
             model = ConvSTAR.load_from_checkpoint(resume_from_checkpoint,
-                                                  map_location=torch.device('cpu'),
+                                                  map_location=map_location,
                                                   run_path=run_path,
                                                   linear_encoder=LINEAR_ENCODER,
-                                                  crop_encoding=crop_encoding,
+                                                  crop_encoding=CROP_ENCODING_LINEAR,
                                                   checkpoint_epoch=init_epoch)
     elif args.model == 'unet':
         args.img_size = [int(dim) for dim in args.img_size]
@@ -307,10 +431,10 @@ def main():
         if not args.train:
             model = UNet.load_from_checkpoint(
                 resume_from_checkpoint,
-                map_location=torch.device('cpu'),
+                map_location=map_location,
                 run_path=run_path,
                 linear_encoder=LINEAR_ENCODER,
-                crop_encoding=crop_encoding,
+                crop_encoding=CROP_ENCODING_LINEAR,
                 checkpoint_epoch=init_epoch,
                 num_layer=3)
 
@@ -328,13 +452,13 @@ def main():
 
         if not args.train:
             model = TempCNN.load_from_checkpoint(args.load_checkpoint,
-                                                 map_location=torch.device('cpu'),
+                                                 map_location=map_location,
                                                  input_dim=3,
                                                  nclasses=n_classes,
                                                  sequence_length=args.window_len,
                                                  run_path=run_path,
                                                  linear_encoder=LINEAR_ENCODER,
-                                                 crop_encoding=crop_encoding)
+                                                 crop_encoding=CROP_ENCODING_LINEAR)
 
     elif args.model == 'utae':
         results_path = create_model_log_path(log_path, prefix, args.model)
@@ -367,10 +491,10 @@ def main():
         if not args.train:
             model = UTAE.load_from_checkpoint(
                 resume_from_checkpoint,
-                map_location=torch.device('cpu'),
+                map_location=map_location,
                 run_path=run_path,
                 linear_encoder=LINEAR_ENCODER,
-                crop_encoding=crop_encoding,
+                crop_encoding=CROP_ENCODING_LINEAR,
                 checkpoint_epoch=init_epoch,
                 input_size=4)
 
@@ -383,7 +507,7 @@ def main():
                       LINEAR_ENCODER,
                       parcel_loss=args.parcel_loss,
                       class_weights=class_weights,
-                      crop_encoding=crop_encoding,
+                      crop_encoding=CROP_ENCODING_LINEAR,
                       shape_in=[timestep,4,64,64],
                       hid_S=64,
                       hid_T=512,
@@ -397,10 +521,10 @@ def main():
         if not args.train:
             model = SimVP.load_from_checkpoint(
                 resume_from_checkpoint,
-                map_location=torch.device('cpu'),
+                map_location=map_location,
                 run_path=run_path,
                 linear_encoder=LINEAR_ENCODER,
-                crop_encoding=crop_encoding,
+                crop_encoding=CROP_ENCODING_LINEAR,
                 class_weights=class_weights,
                 shape_in=[timestep,4,64,64],
                 hid_S=64,
@@ -410,6 +534,21 @@ def main():
                 incep_ker=[3,5,7,11], 
                 groups=8)
 
+    if args.gpu_flips and args.train:
+        model.gpu_transform = BatchRandomFlip()
+
+    if args.channels_last and args.model in ['unet', 'utae', 'simvp']:
+        # Weights in NHWC make cuDNN pick its channels_last kernels, the
+        # activations follow from the first convolution onwards
+        model = model.to(memory_format=torch.channels_last)
+
+    if args.compile and args.train:
+        if hasattr(torch, 'compile'):
+            # Compile the forward only, so that the model remains a LightningModule
+            model.forward = torch.compile(model.forward, mode='reduce-overhead', dynamic=False)
+        else:
+            print(f'{font_colors.YELLOW}torch.compile is not available, running the model eagerly.{font_colors.ENDC}')
+
     # Create Data Modules
     dm = PADDataModule(
         root_dir=args.root_dir,
@@ -421,7 +560,11 @@ def main():
         batch_size=args.batch_size,
         num_workers=args.num_workers,
         binary_labels=args.binary_labels,
-        return_parcels=args.parcel_loss
+        return_parcels=args.parcel_loss,
+        persistent_workers=args.persistent_workers,
+        prefetch_factor=args.prefetch_factor,
+        cuda_prefetch=args.cuda_prefetch,
+        gpu_normalize=args.gpu_normalize
     )
 
     if args.train:
@@ -438,54 +581,61 @@ def main():
         )
 
         tb_logger = pl_loggers.TensorBoardLogger(run_path / 'tensorboard')
-        my_ddp = DDPPlugin(find_unused_parameters=True)
+        checkpoint_io = ThreadedCheckpointIO()
         trainer = pl.Trainer(gpus=args.num_gpus,
                              num_nodes=args.num_nodes,
                              progress_bar_refresh_rate=20,
                              min_epochs=1,
+                             replace_sampler_ddp=False,
                              max_epochs=max_epoch + 1,
                              check_val_every_n_epoch=1,
-                             precision=32,
+                             precision=precision,
                              callbacks=callbacks,
                              logger=tb_logger,
                              gradient_clip_val=10.0,
+                             gradient_clip_algorithm='norm',
                              # early_stop_callback=early_stopping,
                              checkpoint_callback=True,
                              resume_from_checkpoint=resume_from_checkpoint,
                              fast_dev_run=args.devtest,
-                             strategy='ddp' if args.num_gpus > 1 else None,
-                             plugins=[my_ddp]
+                             strategy=create_strategy(args.num_gpus, args.find_unused_parameters),
+                             plugins=[checkpoint_io]
                              )
+        if args.auto_batch_size:
+            if args.num_gpus > 1:
+                print(f'{font_colors.YELLOW}Batch size tuning is not supported with DDP, '
+                      f'using batch size {args.batch_size}.{font_colors.ENDC}')
+            else:
+                # The tuner updates dm.batch_size in place
+                batch_size = Tuner(trainer).scale_batch_size(model, datamodule=dm, mode='power',
+                                                             init_val=args.batch_size)
+                # Drop losses left by the trials, e.g. by one that ran out of memory
+                model.reset_losses()
+
+                # Linear scaling rule. A resumed learning rate is already scaled
+                if batch_size and args.resume is None:
+                    model.learning_rate *= batch_size / args.batch_size
+
         trainer.fit(model, datamodule=dm)
+        # Make sure the last checkpoint is written before moving on
+        checkpoint_io.teardown()
 
-        # Setup to multi-GPUs
+        # Test model with the training Trainer, so that its process group
+        # is reused instead of being set up a second time
         dm.setup('test')
-        my_ddp = DDPPlugin(find_unused_parameters=True)
-        trainer = pl.Trainer(gpus=args.num_gpus,
-                             num_nodes=args.num_nodes,
-                             progress_bar_refresh_rate=1,
-                             min_epochs=1,
-                             max_epochs=2,
-                             precision=32,
-                             strategy='ddp' if args.num_gpus > 1 else None,
-                             plugins=[my_ddp]
-                             )
-        # Test model
-        model.eval()
         trainer.test(model, datamodule=dm)
 
     else:
         # Setup to multi-GPUs
         dm.setup('test')
-        my_ddp = DDPPlugin(find_unused_parameters=True)
         trainer = pl.Trainer(gpus=args.num_gpus,
                              num_nodes=args.num_nodes,
                              progress_bar_refresh_rate=1,
                              min_epochs=1,
+                             replace_sampler_ddp=False,
                              max_epochs=2,
-                             precision=32,
-                             strategy='ddp' if args.num_gpus > 1 else None,
-                             plugins=[my_ddp]
+                             precision=precision,
+                             strategy=create_strategy(args.num_gpus, args.find_unused_parameters)
                              )
         # Test model
         model.eval()
@@ -493,4 +643,9 @@ def main():
 
 
 if __name__ == '__main__':
+    if sys.platform.startswith('linux'):
+        # Forked dataloader workers share the dataset copy-on-write instead
+        # of re-importing the modules and rebuilding it
+        mp.set_start_method('fork', force=True)
+
     main()
@@ -1,20 +1,165 @@
 import numpy as np
 import time
 import torch
+import torch.distributed as dist
 from typing import Any, Union
 from pathlib import Path
-from pycocotools.coco import COCO
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, DistributedSampler, get_worker_info
 import pytorch_lightning as pl
 
-from .settings.config import RANDOM_SEED, IMG_SIZE
-from .PAD_dataset import PADDataset
+from .settings.config import RANDOM_SEED, IMG_SIZE, NORMALIZATION_DIV
 from .npy_dataset import NpyPADDataset
 
 # Set seed for everything
 pl.seed_everything(RANDOM_SEED)
 
 
+class PADBatch:
+    '''
+    Container for a collated PAD batch ('medians', 'labels' and optionally
+    'parcels'). Fields are accessed like a dict, e.g. batch['medians'].
+
+    The DataLoader only pins custom batch types through their own
+    `pin_memory()` method, which is provided here so that `pin_memory=True`
+    pins every tensor field of the batch.
+    '''
+
+    def __init__(self, **tensors) -> None:
+        self.__dict__.update(tensors)
+
+    def __getitem__(self, key):
+        return self.__dict__[key]
+
+    def __setitem__(self, key, value):
+        self.__dict__[key] = value
+
+    def __contains__(self, key):
+        return key in self.__dict__
+
+    def keys(self):
+        return self.__dict__.keys()
+
+    def values(self):
+        return self.__dict__.values()
+
+    def items(self):
+        return self.__dict__.items()
+
+    def pin_memory(self):
+        for k, v in self.__dict__.items():
+            if torch.is_tensor(v):
+                self.__dict__[k] = v.pin_memory()
+        return self
+
+    def to(self, *args, **kwargs):
+        # Lightning only passes non_blocking=True for plain tensors, so
+        # request it here for the (pinned) host to GPU copies
+        device = kwargs.get('device', args[0] if args else None)
+        if isinstance(device, (str, int, torch.device)) and torch.device(device).type != 'cpu':
+            kwargs.setdefault('non_blocking', True)
+
+        return PADBatch(**{
+            k: v.to(*args, **kwargs) if torch.is_tensor(v) else v
+            for k, v in self.__dict__.items()
+        })
+
+
+def _as_tensor(arr):
+    arr = np.asarray(arr)
+    if arr.dtype == np.uint16:
+        # torch has no uint16 dtype, reinterpret the bits as int16
+        arr = arr.view(np.int16)
+    return torch.from_numpy(arr)
+
+
+def fast_collate(samples):
+    '''
+    Collates a list of NpyPADDataset samples into a PADBatch.
+
+    Every field is copied once into a preallocated tensor that keeps the dtype
+    of the samples, so raw uint16 medians are staged at half the size of
+    float32 ones. They are reinterpreted as int16 and restored on the GPU by
+    `PADDataModule.on_after_batch_transfer`.
+    '''
+    batch = {}
+    for key in samples[0].keys():
+        first = _as_tensor(samples[0][key])
+        shape = (len(samples), *first.shape)
+        if get_worker_info() is not None:
+            # Collate straight into shared memory, as default_collate does,
+            # so the batch is not copied again to be sent to the main process
+            storage = first.storage()._new_shared(first.numel() * len(samples))
+            out = first.new(storage).resize_(shape)
+        else:
+            out = torch.empty(shape, dtype=first.dtype)
+        for i, sample in enumerate(samples):
+            out[i].copy_(_as_tensor(sample[key]))
+        batch[key] = out
+
+    return PADBatch(**batch)
+
+
+class PADCudaPrefetcher:
+    '''
+    Wraps a DataLoader and copies the next batch to the GPU on a side CUDA
+    stream, so that the host-to-device transfer overlaps with the computation
+    on the current batch.
+    '''
+
+    def __init__(self, loader: DataLoader, device: torch.device) -> None:
+        '''
+        Parameters
+        ----------
+        loader: DataLoader
+            The DataLoader to wrap. It should use pinned memory for the copies
+            to be truly asynchronous.
+        device: torch.device
+            The CUDA device to copy the batches to.
+        '''
+        self.loader = loader
+        self.dataset = loader.dataset
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device)
+
+        self.iterator = None
+        self.next_batch = None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.iterator = iter(self.loader)
+        self.preload()
+        return self
+
+    def preload(self):
+        try:
+            batch = next(self.iterator)
+        except StopIteration:
+            self.next_batch = None
+            return
+
+        with torch.cuda.stream(self.stream):
+            self.next_batch = batch.to(self.device, non_blocking=True)
+
+    def __next__(self):
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_stream(self.stream)
+
+        batch = self.next_batch
+        if batch is None:
+            raise StopIteration
+
+        # Tensors were allocated on the side stream, mark them as used by the
+        # current one so that their memory is not reused too early
+        for v in batch.values():
+            if torch.is_tensor(v):
+                v.record_stream(current_stream)
+
+        self.preload()
+        return batch
+
+
 class PADDataModule(pl.LightningDataModule):
     # Documentation: https://pytorch-lightning.readthedocs.io/en/latest/extensions/datamodules.html
     '''
@@ -32,7 +177,11 @@ class PADDataModule(pl.LightningDataModule):
             batch_size: int = 64,
             num_workers: int = 4,
             binary_labels: bool = False,
-            return_parcels: bool = False
+            return_parcels: bool = False,
+            persistent_workers: bool = True,
+            prefetch_factor: int = 4,
+            cuda_prefetch: bool = True,
+            gpu_normalize: bool = False
     ) -> None:
         '''
         Parameters
@@ -55,6 +204,19 @@ class PADDataModule(pl.LightningDataModule):
             Map categories to 0 background, 1 parcel.
         return_parcels: bool, default False
             If True, then a boolean mask for the parcels is also returned.
+        persistent_workers: bool, default True
+            If True, the dataloader workers are kept alive between epochs
+            instead of being re-spawned. Ignored when num_workers is 0.
+        prefetch_factor: int, default 4
+            Number of batches loaded in advance by each worker. Ignored when
+            num_workers is 0.
+        cuda_prefetch: bool, default True
+            If True and training runs on GPU, the dataloaders are wrapped in a
+            PADCudaPrefetcher.
+        gpu_normalize: bool, default False
+            If True, the workers return the raw uint16 medians and they are
+            divided by NORMALIZATION_DIV on the GPU after the batch transfer.
+            This replaces the per-sample min-max normalization.
         '''
 
         super().__init__()
@@ -63,6 +225,14 @@ class PADDataModule(pl.LightningDataModule):
         self.batch_size = batch_size
         self.num_workers = num_workers
         self.binary_labels = binary_labels
+        self.persistent_workers = persistent_workers
+        self.prefetch_factor = prefetch_factor
+        self.cuda_prefetch = cuda_prefetch
+        self.gpu_normalize = gpu_normalize
+
+        # Set by train_dataloader() in distributed runs, the LightningModule
+        # must call set_epoch() on it to reshuffle every epoch
+        self.train_sampler = None
 
         # Initialize parameters required for Patches Dataset
         self.band_mode = band_mode
@@ -88,6 +258,7 @@ class PADDataModule(pl.LightningDataModule):
                                                mode='train',
                                                return_parcels=self.return_parcels,
                                                scenario=self.scenario,
+                                               normalize=not self.gpu_normalize,
                                                )
             self.dataset_eval = NpyPADDataset(root_dir=self.root_dir,
                                               band_mode=self.band_mode,
@@ -96,6 +267,7 @@ class PADDataModule(pl.LightningDataModule):
                                               mode='val',
                                               return_parcels=self.return_parcels,
                                               scenario=self.scenario,
+                                              normalize=not self.gpu_normalize,
                                               )
 
         else:
@@ -106,32 +278,81 @@ class PADDataModule(pl.LightningDataModule):
                                               output_size=None, # (H, W) = (366, 366)
                                               mode='test',
                                               return_parcels=self.return_parcels,
-                                              scenario=self.scenario
+                                              scenario=self.scenario,
+                                              normalize=not self.gpu_normalize,
                                               )
 
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        if self.gpu_normalize:
+            medians = batch['medians']
+            if medians.dtype == torch.int16:
+                # Undo the uint16 -> int16 reinterpretation of fast_collate
+                medians = medians.int() & 0xFFFF
+            batch['medians'] = medians.float().div_(NORMALIZATION_DIV)
+        return batch
+
+    def _worker_kwargs(self):
+        # persistent_workers/prefetch_factor are only valid with worker processes
+        if self.num_workers == 0:
+            return {}
+        return {
+            'persistent_workers': self.persistent_workers,
+            'prefetch_factor': self.prefetch_factor
+        }
+
+    def _distributed_sampler(self, dataset, shuffle):
+        # Samplers are created here rather than injected by Lightning, which
+        # cannot see through PADCudaPrefetcher
+        if not (dist.is_available() and dist.is_initialized()):
+            return None
+        return DistributedSampler(dataset, shuffle=shuffle, seed=RANDOM_SEED)
+
+    def _wrap_loader(self, loader):
+        if not self.cuda_prefetch or self.trainer is None:
+            return loader
+
+        device = self.trainer.strategy.root_device
+        if device.type != 'cuda':
+            return loader
+
+        return PADCudaPrefetcher(loader, device)
+
     def train_dataloader(self):
-        return DataLoader(
+        self.train_sampler = self._distributed_sampler(self.dataset_train, shuffle=True)
+        loader = DataLoader(
             self.dataset_train,
             batch_size=self.batch_size,
-            shuffle=True,
+            shuffle=self.train_sampler is None,
+            sampler=self.train_sampler,
             num_workers=self.num_workers,
-            pin_memory=True
+            pin_memory=True,
+            collate_fn=fast_collate,
+            **self._worker_kwargs()
         )
+        return self._wrap_loader(loader)
 
     def val_dataloader(self):
-        return DataLoader(
+        loader = DataLoader(
             self.dataset_eval,
             batch_size=self.batch_size,
             shuffle=False,
+            sampler=self._distributed_sampler(self.dataset_eval, shuffle=False),
             num_workers=self.num_workers,
-            pin_memory=True
+            pin_memory=True,
+            collate_fn=fast_collate,
+            **self._worker_kwargs()
         )
+        return self._wrap_loader(loader)
 
     def test_dataloader(self):
-        return DataLoader(
+        loader = DataLoader(
             self.dataset_test,
             batch_size=self.batch_size,
             shuffle=False,
+            sampler=self._distributed_sampler(self.dataset_test, shuffle=False),
             num_workers=self.num_workers,
-            pin_memory=True
+            pin_memory=True,
+            collate_fn=fast_collate,
+            **self._worker_kwargs()
         )
+        return self._wrap_loader(loader)
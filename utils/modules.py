@@ -1,3 +1,4 @@
+import torch
 from torch import nn
 
 
@@ -63,4 +64,26 @@ class Inception(nn.Module):
         y = 0
         for layer in self.layers:
             y += layer(x)
-        return y
\ No newline at end of file
+        return y
+
+
+class BatchRandomFlip(nn.Module):
+    """
+    Randomly flips each sample of a PAD batch horizontally and vertically on
+    the device the batch lives on. The medians, labels and parcels of a sample
+    are flipped together.
+    """
+    def __init__(self, p=0.5):
+        super(BatchRandomFlip, self).__init__()
+        self.p = p
+
+    def forward(self, batch):
+        medians = batch['medians']  # (B, T, C, H, W)
+        for dim in (-1, -2):
+            flip = torch.rand(medians.shape[0], device=medians.device) < self.p
+            for key in ('medians', 'labels', 'parcels'):
+                if key in batch:
+                    x = batch[key]
+                    mask = flip.view(-1, *([1] * (x.dim() - 1)))
+                    batch[key] = torch.where(mask, x.flip(dim), x)
+        return batch
@@ -4,7 +4,6 @@ import numpy as np
 from typing import Tuple
 
 from torch.utils.data import Dataset
-from pycocotools.coco import COCO
 
 from .settings.config import RANDOM_SEED, BANDS, IMG_SIZE, REFERENCE_BAND, NORMALIZATION_DIV, LINEAR_ENCODER
 
@@ -30,6 +29,16 @@ from .settings.config import RANDOM_SEED, BANDS, IMG_SIZE, REFERENCE_BAND, NORMA
 
 # LINEAR_ENCODER = {val: i + 1 for i, val in enumerate(sorted(SELECTED_CLASSES))}
 # LINEAR_ENCODER[0] = 0
+
+
+def load_npy(path):
+    '''
+    Memory-maps a .npy file, so that slicing it only reads the pages of the
+    requested patch instead of the whole file.
+    '''
+    return np.load(path, mmap_mode='r')
+
+
 def min_max_normalize(image, percentile=2):
     image = image.astype('float32')
 
@@ -67,23 +76,23 @@ class RandomCrop(object):
             assert len(output_size) == 2
             self.output_size = output_size
 
-    def __call__(self, img, ann):
-        image, landmarks = img, ann
-
-        _, _, h, w = image.shape
+    def get_params(self, h, w):
         new_h, new_w = self.output_size
 
         top = np.random.randint(0, h - new_h)
         left = np.random.randint(0, w - new_w)
 
-        image = image[:, :, top: top + new_h,
-                      left: left + new_w]
+        return top, left
 
-        landmarks = landmarks[top: top + new_h, left: left + new_w]
-        img = image
-        ann = landmarks
+    def crop(self, arr, top, left):
+        new_h, new_w = self.output_size
 
-        return img, ann
+        return arr[..., top: top + new_h, left: left + new_w]
+
+    def __call__(self, img, ann):
+        top, left = self.get_params(*ann.shape[-2:])
+
+        return self.crop(img, top, left), self.crop(ann, top, left)
 
 
 class NpyPADDataset(Dataset):
@@ -123,6 +132,7 @@ class NpyPADDataset(Dataset):
             mode: str = 'test',
             scenario: int = 1,
             min_max_normalize: bool = True,
+            normalize: bool = True,
     ) -> None:
         '''
         Args:
@@ -142,6 +152,12 @@ class NpyPADDataset(Dataset):
                 The running mode. Used to determine the correct path for the median files.
             return_parcels: boolean, default False
                 If True, then a boolean mask for the parcels is also returned.
+            min_max_normalize: boolean, default True
+                If True, each sample is scaled by its own percentiles, otherwise
+                it is divided by NORMALIZATION_DIV.
+            normalize: boolean, default True
+                If False, the medians are returned in their stored dtype (uint16)
+                and normalization is left to the caller, e.g. on the GPU.
         '''
 
         self.band_mode = band_mode
@@ -176,6 +192,14 @@ class NpyPADDataset(Dataset):
         self.end_month = end_month - 1
         self.linear_encoder = LINEAR_ENCODER
         self.min_max_normalize = min_max_normalize
+        self.normalize = normalize
+
+        # Lookup table from crop_id to linear id. Ids above the largest known
+        # crop_id are clipped to the last entry, which maps to 0
+        max_crop_id = max(self.linear_encoder.keys())
+        self.linear_lut = np.zeros(max_crop_id + 2, dtype=np.int64)
+        for crop_id, linear_id in self.linear_encoder.items():
+            self.linear_lut[crop_id] = linear_id
 
         self.mode = mode
         self.scenario = scenario
@@ -188,6 +212,16 @@ class NpyPADDataset(Dataset):
             self.img_infos = json.load(st_json)[mode]
             self.img_infos = [f + '.npy' for f in self.img_infos]
 
+        # Resolve the file paths of every sample once, instead of per item.
+        # They are kept in numpy string arrays rather than lists of Python
+        # objects: reading them does not touch any refcount, so the pages
+        # stay shared copy-on-write with the forked dataloader workers
+        rdeg_dir = os.path.join(os.path.dirname(self.img_dir), 'rdeg')
+        self.img_paths = np.array([os.path.join(self.img_dir, f) for f in self.img_infos])
+        self.rdeg_paths = np.array([os.path.join(rdeg_dir, f) for f in self.img_infos])
+        self.ann_paths = np.array([os.path.join(self.ann_dir, f) for f in self.img_infos])
+        self.img_infos = np.array(self.img_infos)
+
         if output_size[0] != IMG_SIZE:
             self.transforms = RandomCrop(output_size[0])
         else:
@@ -200,28 +234,24 @@ class NpyPADDataset(Dataset):
 
 
     def prepare_train_img(self, idx: int) -> dict:
-        if self.band_mode == 'nrgb':
-            readpath = os.path.join(self.img_dir, self.img_infos[idx])
-            img = np.load(readpath)
-        elif self.band_mode == 'rdeg':
-            readpath = os.path.join(self.img_dir, self.img_infos[idx])
-            img = np.load(readpath)
-
-            rdegpath = os.path.join(os.path.dirname(self.img_dir), 'rdeg', self.img_infos[idx])
-            rdeg = np.load(rdegpath)
-            img = np.stack([img, rdeg], axis=1)
-        else:
-            raise RuntimeError
-
-        annpath = os.path.join(self.ann_dir, self.img_infos[idx])
-        ann = np.load(annpath)
-
-        img = img[self.start_month:self.end_month]
+        img = load_npy(self.img_paths[idx])[self.start_month:self.end_month]
+        ann = load_npy(self.ann_paths[idx])
+        if self.band_mode == 'rdeg':
+            rdeg = load_npy(self.rdeg_paths[idx])[self.start_month:self.end_month]
 
         if self.transforms:
-            img, ann = self.transforms(img, ann)
+            # Crop every array while it is still memory-mapped, so that only
+            # the requested patch is read from disk
+            top, left = self.transforms.get_params(*ann.shape[-2:])
+            img = self.transforms.crop(img, top, left)
+            ann = self.transforms.crop(ann, top, left)
+            if self.band_mode == 'rdeg':
+                rdeg = self.transforms.crop(rdeg, top, left)
+
+        if self.band_mode == 'rdeg':
+            img = np.stack([img, rdeg], axis=1)
 
-        return img, ann
+        return np.array(img), np.array(ann)
 
     def _normalize(self, img):
         if self.min_max_normalize:
@@ -237,8 +267,9 @@ class NpyPADDataset(Dataset):
     def __getitem__(self, idx: int) -> dict:
         img, ann = self.prepare_train_img(idx)
 
-        # Normalize data to range [0-1]
-        img = self._normalize(img)
+        if self.normalize:
+            # Normalize data to range [0-1]
+            img = self._normalize(img).astype(np.float32)
 
         out = {}
         if self.return_parcels:
@@ -249,17 +280,11 @@ class NpyPADDataset(Dataset):
             # Map 0: background class, 1: parcel
             ann[ann != 0] = 1
         else:
-            # Map labels to 0-len(unique(crop_id)) see config
-            # labels = np.vectorize(self.linear_encoder.get)(labels)
-            _ = np.zeros_like(ann)
-            for crop_id, linear_id in self.linear_encoder.items():
-                _[ann == crop_id] = linear_id
-            ann = _
-
-        # # Map all classes NOT in linear encoder's values to 0
-        ann[~np.isin(ann, list(self.linear_encoder.values()))] = 0
+            # Map labels to 0-len(unique(crop_id)) see config. Classes not in
+            # the linear encoder are mapped to 0
+            ann = self.linear_lut[np.minimum(ann, len(self.linear_lut) - 1)]
 
-        out['medians'] = img.astype(np.float32)
+        out['medians'] = img
         out['labels'] = ann.astype(np.int64)
 
         return out
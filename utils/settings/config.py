@@ -118,6 +118,11 @@ SELECTED_CLASSES = [
 LINEAR_ENCODER = {val: i + 1 for i, val in enumerate(sorted(SELECTED_CLASSES))}
 LINEAR_ENCODER[0] = 0
 
+# Maps class names to crop ids, and the crop ids of the linear encoder to class names
+CROP_ENCODING_REV = {v: k for k, v in CROP_ENCODING.items()}
+CROP_ENCODING_LINEAR = {k: CROP_ENCODING_REV[k] for k in LINEAR_ENCODER.keys() if k != 0}
+CROP_ENCODING_LINEAR[0] = 'Background/Other'
+
 # ---
 
 # Class weights for loss function
@@ -19,7 +19,7 @@ import matplotlib.patches as mpatches
 
 from utils.tools import font_colors
 from utils.PAD_datamodule import PADDataModule
-from utils.settings.config import CROP_ENCODING, IMG_SIZE, LINEAR_ENCODER, BANDS
+from utils.settings.config import CROP_ENCODING, CROP_ENCODING_LINEAR, IMG_SIZE, LINEAR_ENCODER, BANDS
 
 
 def get_window(idx, window_len, image_size, coco_file):
@@ -264,13 +264,9 @@ if __name__ == '__main__':
             grid2[idx].imshow(pred_sparse, vmin=0, vmax=max(LINEAR_ENCODER.values()), cmap='tab20')
             grid2[idx].set_axis_off()
 
-        crop_encoding_rev = {v: k for k, v in CROP_ENCODING.items()}
-        crop_encoding = {k: crop_encoding_rev[k] for k in LINEAR_ENCODER.keys() if k != 0}
-        crop_encoding[0] = 'Background/Other'
-
         crop_ids = sorted(LINEAR_ENCODER.keys())
         colors = [im.cmap(im.norm(LINEAR_ENCODER[crop_id])) for crop_id in crop_ids]
-        patches = [mpatches.Patch(color=colors[LINEAR_ENCODER[crop_id]], label=f'{crop_id} ({crop_encoding[crop_id]})') for crop_id in crop_ids]
+        patches = [mpatches.Patch(color=colors[LINEAR_ENCODER[crop_id]], label=f'{crop_id} ({CROP_ENCODING_LINEAR[crop_id]})') for crop_id in crop_ids]
         axes[1].legend(handles=patches, bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0., fontsize='x-large')
 
         title_font = {'size':'22'}